@@ -0,0 +1,3 @@
+from dtale_utils.dtale_utils import main
+
+main()
@@ -1,18 +1,23 @@
-import os
+import mmap
 import signal
+import struct
+import sys
 import zipfile
-import tempfile
 import time
 import re
 import socket
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 import click
-import dtale
-import dtale.global_state as global_state
-
-global_state.set_chart_settings({'scatter_points': 150_000,})
 
 DTYPE_SESSIONS = []
 
+_configured = False
+
+# Maps every non-alphanumeric ASCII character to a space, for use with str.translate
+_NON_ALNUM_ASCII = {c: 0x20 for c in range(128) if not chr(c).isalnum()}
+_NON_ALNUM = re.compile(r'[^a-zA-Z0-9]')
+
 def signal_handler(signal, frame):
     print("\nShutting down d-tale")
 
@@ -24,84 +29,228 @@ def signal_handler(signal, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 
-def find_free_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+def reserve_ports(n):
+    # Keep all sockets bound at once, so the host cannot hand out the same port twice
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(n)]
+    for s in socks:
         s.bind(('', 0))  # Bind to a free port provided by the host.
-        return s.getsockname()[1]  # Return the port number assigned.
+    ports = [s.getsockname()[1] for s in socks]  # The port numbers assigned.
+    return socks, ports
 
 def process_symbols(ctx, param, value):
-    if value is None:
-        return set()  # Return an empty set if no names are provided
-    return set(s.strip() for s in value.split(','))
+    if not value:
+        return frozenset()  # Return an empty set if no names are provided
+    return frozenset(s.strip() for s in value.split(','))
+
+def process_columns(ctx, param, value):
+    if not value:
+        return None  # Load all columns if none are provided
+    return [c.strip() for c in value.split(',')]
+
+
+def _configure_dtale():
+    global _configured
+    if _configured:
+        return
+    # dtale is slow to import, so it is only imported once there are sessions to start.
+    # This keeps e.g. --help fast.
+    import dtale.global_state as global_state
+
+    global_state.set_chart_settings({'scatter_points': 150_000,})
+    _configured = True
+
+
+def _map_stored_member(zip_ref, info):
+    # A stored member's bytes sit uncompressed in the archive, right after its local
+    # file header. That header's extra field can differ from the central directory's,
+    # so its length is read from the file rather than taken from info.
+    zip_ref.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, zip_ref.fp.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad magic number for file header of {info.filename}")
+    filename_length, extra_length = header[10], header[11]
+    data_offset = info.header_offset + zipfile.sizeFileHeader + filename_length + extra_length
+
+    # mmap offsets must be aligned to the allocation granularity
+    map_offset = data_offset - data_offset % mmap.ALLOCATIONGRANULARITY
+    mm = mmap.mmap(zip_ref.fp.fileno(), length=data_offset - map_offset + info.file_size,
+                   offset=map_offset, access=mmap.ACCESS_READ)
+    # The memoryview keeps the mapping alive for as long as anything references the data
+    return memoryview(mm)[data_offset - map_offset:]
+
+
+def _read_parquet_member(zip_ref, info, columns=None):
+    # Imported here rather than at module level, for the same reason as dtale
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Read a Parquet member straight out of the archive, without touching disk
+    if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1 and info.file_size > 0:
+        # Stored members are mapped in place, so nothing is copied or decompressed
+        data = pa.py_buffer(_map_stored_member(zip_ref, info))
+    else:
+        with zip_ref.open(info) as fh:
+            data = fh.read()
+    if columns is not None:
+        # Only ask for the requested columns this member has, so one file lacking a
+        # column does not fail the whole run
+        names = set(pq.read_schema(pa.BufferReader(data)).names)
+        columns = [c for c in columns if c in names]
+    # BufferReader wraps the bytes without copying, unlike BytesIO
+    return pq.read_table(pa.BufferReader(data), columns=columns,
+                         use_threads=True, pre_buffer=True)
+
+
+def _read_symbol(zip_file_path, infos, columns):
+    import pandas as pd
+
+    # zipfile handles are not thread-safe, so every worker opens its own
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        tables = [_read_parquet_member(zip_ref, info, columns=columns) for info in infos]
+    # The columns actually read, so the caller can check them against the requested ones
+    column_names = set().union(*(t.column_names for t in tables))
+    # Free each Arrow column as soon as it has been converted, to keep peak memory down
+    dfs = [t.to_pandas(self_destruct=True, split_blocks=True) for t in tables]
+    del tables
+    # The parts of a directory dataset are stacked into one frame
+    df = dfs[0] if len(dfs) == 1 else pd.concat(dfs, ignore_index=True)
+    return df, column_names
 
 
 @click.command()
 @click.argument("zip_path")
 @click.option('--symbols', help='Symbols to load from the zip', type=str, required=False, callback=process_symbols)
-def main(zip_path, symbols):
+@click.option('--columns', help='Columns to load from each parquet', type=str, required=False, callback=process_columns)
+def main(zip_path, symbols, columns):
     """
     Simple CLI for loading zipped parquets into dtale
     """
     click.echo(f'Loading dataframes from {zip_path}')
 
-    DTYPE_SESSIONS = zipped_parquet_to_dtale(zip_path, symbols_to_include=symbols)
-    [print(d._main_url) for d in DTYPE_SESSIONS]
+    # Fill the module-level list in place, so the SIGINT handler can kill the sessions
+    DTYPE_SESSIONS[:] = zipped_parquet_to_dtale(zip_path, symbols_to_include=symbols, columns=columns)
+    if not DTYPE_SESSIONS:
+        click.echo('No parquet members matched', err=True)
+        sys.exit(1)
+    for d in DTYPE_SESSIONS:
+        print(d._main_url)
     DTYPE_SESSIONS[-1].open_browser()
 
     print("Running. Press Ctrl+C to exit.")
-    while True:
-        # The program does nothing here and waits to be killed
-        time.sleep(1)
+    # The program does nothing here and waits to be killed
+    try:
+        # pause returns after any handled signal, so only the SIGINT handler gets us out
+        while True:
+            signal.pause()
+    except AttributeError:
+        # signal.pause is not available on Windows, and Ctrl+C does not interrupt
+        # an untimed wait there, so poll instead
+        while True:
+            time.sleep(1)
 
 
 
-def zipped_parquet_to_dtale(zip_file_path, symbols_to_include: set[str]):
+def zipped_parquet_to_dtale(zip_file_path, symbols_to_include: set[str], columns: Optional[list[str]] = None):
     """
-    Extracts Parquet files from a ZIP archive and loads each into a D-Tale session.
+    Reads Parquet files from a ZIP archive and loads each into a D-Tale session.
     
-    Each Parquet file within the ZIP archive is read into a Pandas DataFrame,
-    and a D-Tale session is launched for it. The name of the session is set to
-    the name of the Parquet file (without the file extension). The function
-    prints the URLs for each D-Tale session.
+    Each Parquet file at the top level of the ZIP archive is read directly into
+    a Pandas DataFrame, without being extracted to disk first, and a D-Tale
+    session is launched for it. A top-level directory of Parquet part files
+    (e.g. Spark output) is loaded as one DataFrame. The name of the session is
+    set to the name of the Parquet file or directory (without the extension).
 
     Parameters
     ----------
     zip_file_path : str
         The file path to the ZIP archive containing Parquet files.
+    symbols_to_include : set of str
+        Names of the Parquet files or directories (without extension) to load.
+        All are loaded if empty.
+    columns : list of str, optional
+        Columns to read from each Parquet file. All columns are read if None.
+        Columns a file does not have are skipped for that file, and files with
+        none of the columns are not loaded.
 
     Returns
     -------
-    None
-        This function does not return a value. It prints the URL for each
-        D-Tale session created for the Parquet files extracted from the ZIP archive.
+    list of dtale.views.DtaleData
+        One D-Tale instance per Parquet file or directory loaded, sorted by session name.
+        Empty if no Parquet file in the ZIP archive was selected.
+
+    Raises
+    ------
+    ValueError
+        If one of the requested columns is not found in any of the Parquet files.
 
     Examples
     --------
     >>> zipped_parquet_to_dtale('/tmp/dtale.zip', symbols_to_include={'I_py', 'P_py'})
     """
-    # Using a temporary directory to extract the Parquet files
-
-    with tempfile.TemporaryDirectory() as extract_dir:
-        # Unzipping the Parquet files
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
-
-        # List all the Parquet files extracted
-        parquet_files = [f for f in os.listdir(extract_dir) if f.endswith('.parquet')]
-
-        ds = []
-        # Loop through each Parquet file, read the data, and start a D-Tale session
-        for i_, file_name in enumerate(sorted(parquet_files)):
-            pth_ = os.path.join(extract_dir, file_name)
-            # Use the file name (without the extension) as the name of the D-Tale session
-            symbol_name = os.path.splitext(file_name)[0]
-            if (len(symbols_to_include) > 0) and (symbol_name not in symbols_to_include):
+    # Group the Parquet members by symbol name, the top-level file or directory name
+    # without the extension, which is also used as the name of the D-Tale session
+    parts = {}
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            path = info.filename.split('/')
+            # Anything outside a top-level X.parquet entry is not loaded, e.g. __MACOSX/
+            # resource forks or files in ordinary subfolders
+            if info.is_dir() or not path[0].endswith('.parquet'):
                 continue
-
+            symbol_name = path[0][:-len('.parquet')]
+            if symbols_to_include and symbol_name not in symbols_to_include:
+                continue
+            if len(path) == 1:
+                parts.setdefault(symbol_name, []).append(info)
+            elif len(path) == 2:
+                # Part files of a directory dataset, e.g. as written by Spark. Like pyarrow
+                # datasets, skip files starting with '_' or '.', such as _SUCCESS
+                if path[1].endswith('.parquet') and not path[1].startswith(('_', '.')):
+                    parts.setdefault(symbol_name, []).append(info)
+            elif info.filename.endswith('.parquet'):
+                print(f"Skipping {info.filename}: nested directories in a dataset are not supported")
+    if not parts:
+        return []
+    members = sorted((symbol_name, sorted(infos, key=lambda info: info.filename))
+                     for symbol_name, infos in parts.items())
+
+    # Read the symbols in parallel. All of them are read before any session is started,
+    # so a bad member does not leave sessions running behind it.
+    with ThreadPoolExecutor(max_workers=min(8, len(members))) as ex:
+        results = list(ex.map(lambda m: _read_symbol(zip_file_path, m[1], columns), members))
+
+    if columns is not None:
+        # A column found in no file at all is most likely a typo
+        found = set().union(*(column_names for _, column_names in results))
+        missing = [c for c in columns if c not in found]
+        if missing:
+            raise ValueError(f"Columns not found in any Parquet file: {', '.join(missing)}")
+
+    loaded = []
+    for (symbol_name, _), (df, column_names) in zip(members, results):
+        # Don't open empty sessions for symbols that have none of the requested columns
+        if columns is not None and not column_names:
+            print(f"Skipping {symbol_name}: none of the requested columns were found")
+            continue
+        loaded.append((symbol_name, df))
+
+    _configure_dtale()
+    import dtale
+
+    # Reserve all the ports up front, so the host cannot hand out the same one twice
+    socks, ports = reserve_ports(len(loaded))
+
+    # D-Tale keeps global state about its sessions, so they are started one at a time
+    ds = []
+    try:
+        for (symbol_name, df), sock, port in zip(loaded, socks, ports):
             name_ = replace_non_alphanumeric_with_space(symbol_name)
             print(f"Loaded {name_}")
-            ds.append(dtale.show_parquet(path=pth_, name=name_, subprocess=True, port=find_free_port()))
-
+            sock.close()  # Release the reserved port right before D-Tale binds it
+            ds.append(dtale.show(df, name=name_, subprocess=True, port=port))
+    finally:
+        for s in socks:
+            s.close()
 
     return ds
 
@@ -132,8 +281,9 @@ def replace_non_alphanumeric_with_space(s):
     ----
     Alphanumeric characters are defined as letters (both uppercase and lowercase) and digits.
     """
-    pattern = r'[^a-zA-Z0-9]'
-    return re.sub(pattern, ' ', s)
+    if s.isascii():
+        return s.translate(_NON_ALNUM_ASCII)
+    return _NON_ALNUM.sub(' ', s)
 
 
 